@@ -7,19 +7,20 @@ import time
 import logging
 import psutil
 import numpy as np
-import dask.array as da
 
-from astropy.io import fits
-from casacore.tables import table
-from glob import glob
+from numpy.polynomial import chebyshev as cheb
 from concurrent.futures import ThreadPoolExecutor
 from functools import partial
-from dask import compute
 
 import smops.cmdline as cmd
 
 GB = 2**30
 MAX_MEM = None
+# approximate working set of each pixel tile during output evaluation
+TILE_BYTES = 2**21
+# relative singular value cutoff for the least squares fallback of the fit.
+# The Cholesky solve only fails once cond(xfit)**2 nears 1/eps(float64)
+LSTSQ_RCOND = 1e-8
 
 def configure_logger(out_dir="."):
     formatter = logging.Formatter(
@@ -47,12 +48,34 @@ def configure_logger(out_dir="."):
 
 
 def get_ms_ref_freq(ms_name):
+    from casacore.tables import table
+
     snitch.info("Getting reference frequency from MS")
     with table(f"{ms_name}::SPECTRAL_WINDOW", ack=False) as spw_subtab:
         ref_freq, = spw_subtab.getcol("REF_FREQUENCY")
     return ref_freq
 
 
+def get_freq_axis(header):
+    """
+    Find the frequency axis of an image
+
+    Parameters
+    ----------
+    header: :obj:`astropy.io.fits.Header`
+        Image header
+
+    Output
+    ------
+    freq_axis: int or None
+        FITS (1-based) number of the axis in Hz. None if there is none
+    """
+    for i in range(1, header["NAXIS"]+1):
+        if header[f"CUNIT{i}"].lower() == "hz":
+            return i
+    return None
+
+
 def read_input_image_header(im_name):
     """
     Parameters
@@ -63,29 +86,77 @@ def read_input_image_header(im_name):
     Output
     ------
     info: dict
-        Dictionary containing center frequency, frequency delta and image wsum
+        Dictionary containing center frequency, frequency delta, image wsum,
+        a copy of the header and the memory-mapped image data. The data is
+        only read from disk once it is accessed, i.e. in
+        :func:`concat_models`
     """
+    from astropy.io import fits
+
     snitch.debug(f"Reading image: {im_name} header")
     info = {}
 
     info["name"] = im_name
    
-    with fits.open(im_name, readonly=True) as hdu_list:
+    with fits.open(im_name, mode="denywrite", memmap=True) as hdu_list:
         # print(f"There are:{len(hdu_list)} HDUs in this image")
         for hdu in hdu_list:
-            naxis = hdu.header["NAXIS"]
             # get the center frequency
-            for i in range(1, naxis+1):
-                if hdu.header[f"CUNIT{i}"].lower() == "hz":
-                    info["freq"] = hdu.header[f"CRVAL{i}"]
-                    info["freq_delta"] = hdu.header[f"CDELT{i}"]
+            i = get_freq_axis(hdu.header)
+            if i is not None:
+                info["freq"] = hdu.header[f"CRVAL{i}"]
+                info["freq_delta"] = hdu.header[f"CDELT{i}"]
 
             #get the wsum
             info["wsum"] = hdu.header["WSCVWSUM"]
             info["data"] = hdu.data
+            # kept so the first image can serve as the output template
+            info["header"] = hdu.header.copy()
     return info
 
 
+def find_input_images(input_pref, stokes):
+    """
+    Find the input model images in a single pass over their directory
+
+    Parameters
+    ----------
+    input_pref: str
+        Absolute input image prefix, as used for wsclean
+    stokes: str
+        Stokes parameter of the images, e.g. I
+
+    Output
+    ------
+    images_list: list
+        Image names sorted by channel number. Images carrying :obj:`stokes`
+        in their name are preferred over those without any stokes
+    explicit_stokes: str or None
+        :obj:`stokes` if the images carry it in their name, otherwise None
+    """
+    input_dir, input_base = os.path.split(input_pref)
+    pattern = re.compile(
+        rf"{re.escape(input_base)}-([0-9]{{4}})"
+        rf"(-{re.escape(stokes)})?-model\.fits")
+
+    with_stokes, without_stokes = [], []
+    try:
+        with os.scandir(input_dir) as entries:
+            for entry in entries:
+                match = pattern.fullmatch(entry.name)
+                if match is None:
+                    continue
+                images = with_stokes if match.group(2) else without_stokes
+                images.append((int(match.group(1)), entry.path))
+    except (FileNotFoundError, NotADirectoryError):
+        # no images, let the caller report it
+        return [], None
+
+    if with_stokes:
+        return [name for _, name in sorted(with_stokes)], stokes
+    return [name for _, name in sorted(without_stokes)], None
+
+
 def get_band_start_and_band_width(freq_delta, first_freq, last_freq):
     """
     Parameters
@@ -135,13 +206,9 @@ def gen_out_freqs(band_start, band_width, n_bands, return_cdelt=False):
     """
     snitch.info("Generating output center frequencies")
     cdelt = band_width/n_bands
-    first_center_freq = band_start + (cdelt/2)
+    center_freqs = band_start + cdelt*(
+        0.5 + np.arange(n_bands, dtype=np.float64))
 
-    center_freqs = [first_center_freq]
-    for i in range(n_bands-1):
-        center_freqs.append(center_freqs[-1] + cdelt)
-
-    center_freqs = np.array(center_freqs)
     if return_cdelt:
         return center_freqs, cdelt
     else:
@@ -151,7 +218,40 @@ def gen_out_freqs(band_start, band_width, n_bands, return_cdelt=False):
 def concat_models(models):
     """Concatenate/stack model images over frequency axis"""
     snitch.info(f"Concatenating {len(models)} model images")
-    return np.concatenate(models, axis=1).squeeze()
+    nx, ny = models[0].shape[-2:]
+    # FITS data is big-endian, the cube is kept in native byte order
+    cube = np.empty((len(models), nx, ny),
+                    dtype=models[0].dtype.newbyteorder("="))
+    for i, mod in enumerate(models):
+        # copy each plane straight into the cube, no intermediate concatenation
+        cube[i] = mod.reshape(nx, ny)
+    return cube
+
+
+def eval_cheb(x, comps):
+    """
+    Evaluate the Chebyshev series at each frequency using Clenshaw's recurrence
+
+    Parameters
+    ----------
+    x: ndarray
+        Frequencies mapped onto the Chebyshev domain [-1, 1]
+    comps: ndarray
+        Chebyshev coefficients of shape (poly_order, npix), lowest order first
+
+    Output
+    ------
+    out: ndarray
+        Series evaluated at each frequency, shape (x.size, npix)
+    """
+    x = x[:, np.newaxis]
+    ones = np.ones(x.shape, dtype=comps.dtype)
+    if comps.shape[0] == 1:
+        return ones * comps[0]
+    b1, b2 = ones * comps[-1], 0
+    for k in range(comps.shape[0]-2, 0, -1):
+        b1, b2 = comps[k] + 2*x*b1 - b2, b1
+    return comps[0] + x*b1 - b2
 
 
 def interp_cube(model, wsums, infreqs, outfreqs, ref_freq, spectral_poly_order):
@@ -179,6 +279,8 @@ def interp_cube(model, wsums, infreqs, outfreqs, ref_freq, spectral_poly_order):
         the order of the spectral polynomial
     """
 
+    from scipy.linalg import cho_factor, cho_solve, lstsq, LinAlgError
+
     snitch.info("Starting frequency interpolation")
 
     nchan = outfreqs.size
@@ -186,12 +288,11 @@ def interp_cube(model, wsums, infreqs, outfreqs, ref_freq, spectral_poly_order):
 
     result = {"xdims": nx, "ydims": ny}
 
-    # components excluding zeros
-    mask = np.any(model, axis=0)
-    beta = model*mask
-    beta = beta.reshape(nband, -1)
-    beta = np.ma.masked_invalid(beta)
-    beta.fill_value = np.nan
+    # float32 is plenty for model images and halves the memory traffic
+    beta = model.reshape(nband, -1).astype(np.float32, copy=False)
+    # dense components: non-finite values are zeroed so that they do not
+    # contribute to the fit. Pixels that are zero in every band fit to zero
+    beta = np.where(np.isfinite(beta), beta, 0)
    
     if spectral_poly_order > infreqs.size:
         raise ValueError(f"spectral-poly-order can't be larger than nband ({nband})")
@@ -202,46 +303,87 @@ def interp_cube(model, wsums, infreqs, outfreqs, ref_freq, spectral_poly_order):
 
     wlow = (infreqs - delta_freq/2.0)/ref_freq
     whigh = (infreqs + delta_freq/2.0)/ref_freq
-    wdiff = whigh - wlow
 
-    # set design matrix for each component
-    # look at Offringa and Smirnov 1706.06786
-    xfit = np.zeros([nband, spectral_poly_order])
-    for i in range(1, spectral_poly_order+1):
-        xfit[:, i-1] = (whigh**i - wlow**i)/(i*wdiff)
+    # fit in a Chebyshev basis over the band mapped onto [-1, 1]. The
+    # monomial basis gets ill-conditioned quickly with the polynomial order
+    wmin, wmax = wlow[0], whigh[-1]
 
+    def to_domain(_w):
+        return 2*(_w - wmin)/(wmax - wmin) - 1
 
-    dirty_comps = np.ma.dot(xfit.T, wsums*beta)
-    hess_comps = xfit.T.dot(wsums*xfit)
+    xlow, xhigh = to_domain(wlow), to_domain(whigh)
 
-    comps = da.from_array(
-        np.linalg.solve(hess_comps, dirty_comps),
-        chunks="auto")
+    # set design matrix for each component: the mean of each basis
+    # polynomial over the input channel
+    # look at Offringa and Smirnov 1706.06786
+    antideriv = cheb.chebint(np.eye(spectral_poly_order), axis=0)
+    xfit = (cheb.chebvander(xhigh, spectral_poly_order).dot(antideriv)
+            - cheb.chebvander(xlow, spectral_poly_order).dot(antideriv))
+    xfit /= (xhigh - xlow)[:, np.newaxis]
+
+    # fold the wsums weighting into the (small) design matrix, so the large
+    # nband x npix cube goes through a single SGEMM and is never reweighted
+    xfit_w = wsums*xfit
+
+    # products with the large cube stay in float32, the small
+    # poly_order x poly_order solve is done in float64
+    dirty_comps = xfit_w.T.astype(np.float32) @ beta
+    hess_comps = xfit_w.T.dot(xfit)
+
+    # the hessian is a weighted Gram matrix, i.e. symmetric positive
+    # definite, so use a Cholesky solve.
+    # comps is only poly_order x npix, it always fits in memory
+    try:
+        comps = cho_solve(cho_factor(hess_comps),
+                          dirty_comps.astype(np.float64))
+    except LinAlgError:
+        snitch.warning("Hessian is not positive definite, falling back to "
+                       "least squares. Consider reducing the polynomial order")
+        # solve the weighted design matrix itself rather than the normal
+        # equations, whose condition number is its square. The projection
+        # pinv(sqrt(W) xfit) sqrt(W) is small and applied to the cube at once
+        sqrt_w = np.sqrt(wsums.ravel())
+        proj, *_ = lstsq(sqrt_w[:, np.newaxis]*xfit, np.diag(sqrt_w),
+                         cond=LSTSQ_RCOND)
+        comps = proj.astype(np.float32) @ beta
+    comps = comps.astype(np.float32)
+    npix = comps.shape[1]
+
+    x = to_domain(outfreqs/ref_freq).astype(np.float32)
+
+    # autogenerate the channel step from the memory cap. Each chunk is
+    # step x npix, and main holds two of them (one being written out while
+    # the next is evaluated). Evaluation temporaries are per pixel tile
+    step = max(1, int((MAX_MEM*GB)//(2*npix*comps.itemsize)))
+    result["nbytes"] = min(step, nchan) * npix * comps.itemsize
+
+    def betaout():
+        # evaluate one channel chunk at a time to stay within the memory cap
+        for _i in range(0, nchan, step):
+            end = _i+step if _i+step < nchan else nchan
+            snitch.info(f"Selecting channel {_i:4} >> {end:2}")
+            # tile over pixels so that each tile of comps and the Clenshaw
+            # temporaries stay in cache while all channels are evaluated
+            out = np.empty((end-_i, npix), dtype=comps.dtype)
+            pix_step = max(1, TILE_BYTES//(3*(end-_i)*comps.itemsize))
+            for p0 in range(0, npix, pix_step):
+                p1 = min(p0+pix_step, npix)
+                out[:, p0:p1] = eval_cheb(x[_i:end], comps[:, p0:p1])
+            yield (_i, end), out
+    result["data"] = betaout()
 
-    w = outfreqs/ref_freq
-    
-    xeval = w[:, np.newaxis]**np.arange(spectral_poly_order)[np.newaxis, :]
-
-    # autogenerate step size. x by 3 coz betaout subarray grwos by 3
-    step = int((MAX_MEM*GB)//(comps.nbytes*0.8))
-    betaout = dict()
-    for _i in range(0, nchan, step):
-        end = _i+step if _i+step < nchan else nchan
-        betaout[_i, end] = da.dot(xeval[_i:end], comps).rechunk("auto")
-        if "nbytes" not in result:
-            result["nbytes"] = betaout[_i, end].nbytes
-        snitch.info(f"Selecting channel {_i:4} >> {end:2}"); 
-    result["data"] = betaout
-    
     return result
 
 
-def gen_fits_file_from_template(template_fits, center_freq, cdelt, new_data, out_fits):
+def gen_fits_file_from_template(template_header, freq_axis, center_freq, cdelt,
+                                new_data, out_fits):
     """
-    Generate new FITS file from some template file
+    Generate new FITS file from some template header
     
-    template_fits: str
-        Name of the file to use as template
+    template_header: :obj:`astropy.io.fits.Header`
+        Header of the file to use as template. It is copied, not modified
+    freq_axis: int or None
+        Frequency axis of the template, see :func:`get_freq_axis`
     center_freq: float
         New center frequency for this image
     cdelt: float
@@ -251,28 +393,25 @@ def gen_fits_file_from_template(template_fits, center_freq, cdelt, new_data, out
     out_fits: str
         Name of the new output file
     """
-    with fits.open(template_fits, mode="readonly") as temp_hdu_list:
-        temp_hdu, = temp_hdu_list
-
-        #update the center frequency
-        for i in range(1, temp_hdu.header["NAXIS"]+1):
-            if temp_hdu.header[f"CUNIT{i}"].lower() == "hz":
-                temp_hdu.header[f"CRVAL{i}"] = center_freq
-                temp_hdu.header[f"CDELT{i}"] = cdelt
-      
-        #update with the new data
-        if temp_hdu.data.ndim == 4:
-            temp_hdu.data[0,0] = new_data
-        elif temp_hdu.data.ndim == 3:
-            temp_hdu.data[0] = new_data
-        elif temp_hdu.data.ndim == 2:
-            temp_hdu.data = new_data
-        temp_hdu_list.writeto(out_fits, overwrite=True)
+    from astropy.io import fits
+
+    header = template_header.copy()
+
+    #update the center frequency
+    if freq_axis is not None:
+        header[f"CRVAL{freq_axis}"] = center_freq
+        header[f"CDELT{freq_axis}"] = cdelt
+
+    #pad the new data back to the dimensions of the template
+    new_data = new_data.reshape((1,)*(header["NAXIS"]-2) + new_data.shape)
+    hdu = fits.PrimaryHDU(data=new_data, header=header)
+    hdu.writeto(out_fits, overwrite=True)
     snitch.info(f"New file written to: {out_fits}")
     return
 
 
-def write_model_out(chan_num, chan_id, temp_fname, out_pref, cdelt, models, freqs, stokes=None):
+def write_model_out(chan_num, chan_id, temp_header, freq_axis, out_pref, cdelt,
+                    models, freqs, stokes=None):
     """
     Write the new models output
 
@@ -285,8 +424,10 @@ def write_model_out(chan_num, chan_id, temp_fname, out_pref, cdelt, models, freq
     chan_id: int
         Actual channel number in the 'grand scheme' of things. Mostly for 
         naming purposes.
-    temp_fname: str
-        Name of the template file that will be used
+    temp_header: :obj:`astropy.io.fits.Header`
+        Header of the template image that will be used
+    freq_axis: int or None
+        Frequency axis of the template image
     out_pref: str
         Prefix of the output models
     cdelt: float
@@ -306,7 +447,7 @@ def write_model_out(chan_num, chan_id, temp_fname, out_pref, cdelt, models, freq
         outname = out_pref + '-' + f"{chan_id}".zfill(4) + f"-{stokes.upper()}-model.fits"
 
     gen_fits_file_from_template(
-        temp_fname, freqs[chan_id], cdelt,
+        temp_header, freq_axis, freqs[chan_id], cdelt,
         models[chan_num], outname)
 
 
@@ -345,18 +486,8 @@ def main():
         
         input_pref = os.path.abspath(args.input_prefix)
 
-        EXPLICIT_STOKES = stokes
-        images_list = sorted(
-            glob(f"{input_pref}-[0-9][0-9][0-9][0-9]-{stokes}-model.fits"),
-            key=os.path.getctime)
+        images_list, EXPLICIT_STOKES = find_input_images(input_pref, stokes)
 
-        if len(images_list) == 0:
-            EXPLICIT_STOKES = None
-            images_list = sorted(
-                glob(f"{input_pref}-[0-9][0-9][0-9][0-9]-model.fits"),
-                key=os.path.getctime)
-        
-    
         if len(images_list) == 0:
             snitch.warning("No image files were found")
             sys.exit(-1)
@@ -366,12 +497,10 @@ def main():
                 snitch.info(os.path.basename(_im))
             snitch.info("."*len(os.path.basename(_im)))
 
-        im_heads = []
+        # executor.map keeps the input order, so im_heads follows images_list
+        with ThreadPoolExecutor(args.nthreads) as executor:
+            im_heads = list(executor.map(read_input_image_header, images_list))
 
-        for im_name in images_list:
-            im_header = read_input_image_header(im_name)
-            im_heads.append(im_header)
-        
         bstart, bwidth = get_band_start_and_band_width(
             im_heads[0]["freq_delta"], im_heads[0]["freq"], im_heads[-1]["freq"])
 
@@ -390,25 +519,34 @@ def main():
         mod_data = mod_out["data"]
         
         
-        for chan_range, data in mod_data.items():
-            data, = compute(data)
-            data = data.reshape(-1, mod_out["xdims"], mod_out["ydims"])
-
-            chan_ids = range(*chan_range)
-            chan_range = range(len(chan_ids))
-
-            results = []
-            with ThreadPoolExecutor(args.nthreads) as executor:
+        # the first input image is the template for all the output channels
+        temp_header = im_heads[0]["header"]
+        freq_axis = get_freq_axis(temp_header)
+
+        results = []
+        with ThreadPoolExecutor(args.nthreads) as executor:
+            # the next chunk is evaluated while the writes of the previous
+            # one are still running
+            for chan_range, data in mod_data:
+                data = data.reshape(-1, mod_out["xdims"], mod_out["ydims"])
+
+                chan_ids = range(*chan_range)
+                chan_range = range(len(chan_ids))
+
+                # wait for the previous chunk to be written before queueing
+                # this one, so at most two chunks are held in memory
+                results = list(results)
                 results = executor.map(
-                    partial(write_model_out, temp_fname=images_list[0],
+                    partial(write_model_out, temp_header=temp_header,
+                            freq_axis=freq_axis,
                             out_pref=args.output_pref, cdelt=new_cdelt,
                             models=data, freqs=out_freqs, stokes=EXPLICIT_STOKES), 
                     chan_range, chan_ids)
 
+                snitch.info("Chunk change over") 
+                snitch.info("*"*50)
             results = list(results)
-            snitch.info("Chunk change over") 
-            snitch.info("*"*50)
-        
+
         snitch.info(f"Stoke's {stokes} finished in {time.perf_counter() - START_TIME:.3f} secs")
 
 
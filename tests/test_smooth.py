@@ -0,0 +1,141 @@
+"""Tests for `smops.smooth`."""
+import logging
+import os
+
+import numpy as np
+import pytest
+import scipy.linalg
+
+from numpy.polynomial import chebyshev as cheb
+
+from smops import smooth
+
+
+@pytest.fixture(autouse=True)
+def setup_globals(monkeypatch):
+    # normally set up by main()
+    monkeypatch.setattr(smooth, "snitch", logging.getLogger("smops"),
+                        raising=False)
+    monkeypatch.setattr(smooth, "MAX_MEM", 1)
+
+
+def monomial_fit(model, wsums, infreqs, outfreqs, ref_freq, order):
+    """Reference: the original monomial normal-equation fit"""
+    nband = model.shape[0]
+    beta = np.nan_to_num(model.reshape(nband, -1).astype(np.float64))
+    delta_freq = infreqs[1] - infreqs[0]
+    wlow = (infreqs - delta_freq/2.0)/ref_freq
+    whigh = (infreqs + delta_freq/2.0)/ref_freq
+    xfit = np.zeros([nband, order])
+    for i in range(1, order+1):
+        xfit[:, i-1] = (whigh**i - wlow**i)/(i*(whigh - wlow))
+    comps = np.linalg.solve(xfit.T.dot(wsums*xfit), xfit.T.dot(wsums*beta))
+    w = outfreqs/ref_freq
+    xeval = w[:, np.newaxis]**np.arange(order)[np.newaxis, :]
+    return xeval.dot(comps).reshape(-1, *model.shape[1:])
+
+
+def collect(result):
+    """Gather the channel chunks returned by interp_cube into one cube"""
+    chunks = dict(result["data"])
+    data = np.concatenate([np.asarray(chunks[key]) for key in sorted(chunks)])
+    return data.reshape(-1, result["xdims"], result["ydims"])
+
+
+@pytest.mark.parametrize("order", [1, 2, 3, 5])
+def test_eval_cheb(order):
+    rng = np.random.default_rng(order)
+    comps = rng.normal(size=(order, 7))
+    x = np.linspace(-1, 1, 11)
+    np.testing.assert_allclose(smooth.eval_cheb(x, comps),
+                               cheb.chebval(x, comps, tensor=True).T)
+
+
+@pytest.mark.parametrize("order", [1, 2, 3, 4])
+def test_interp_cube(order):
+    rng = np.random.default_rng(order)
+    nband, nx, ny = 8, 6, 5
+    infreqs = 1e9 + 1e8*np.arange(nband)
+    outfreqs = np.linspace(infreqs[0], infreqs[-1], 13)
+    ref_freq = 1.3e9
+    wsums = rng.uniform(0.5, 2, size=(nband, 1))
+
+    model = rng.uniform(0.1, 5, size=(nband, nx, ny)).astype(np.float32)
+    model[:, 0, 0] = 0
+    model[3, 1, 2] = np.nan
+
+    result = smooth.interp_cube(model, wsums, infreqs, outfreqs, ref_freq,
+                                order)
+    got = collect(result)
+    expected = monomial_fit(model, wsums, infreqs, outfreqs, ref_freq, order)
+
+    assert got.shape == (outfreqs.size, nx, ny)
+    np.testing.assert_allclose(got, expected, rtol=1e-4,
+                               atol=1e-5*np.abs(expected).max())
+    assert np.all(got[:, 0, 0] == 0)
+
+
+def test_interp_cube_min_chunk(monkeypatch):
+    rng = np.random.default_rng(7)
+    infreqs = 1e9 + 1e8*np.arange(6)
+    outfreqs = np.linspace(infreqs[0], infreqs[-1], 5)
+    model = rng.uniform(0.1, 5, size=(6, 4, 3)).astype(np.float32)
+    args = (model, np.ones((6, 1)), infreqs, outfreqs, 1.3e9, 3)
+
+    expected = collect(smooth.interp_cube(*args))
+    # a memory cap that rounds down to 0 GB evaluates a channel at a time
+    monkeypatch.setattr(smooth, "MAX_MEM", 0)
+    chunks = dict(smooth.interp_cube(*args)["data"])
+    assert sorted(chunks) == [(i, i+1) for i in range(outfreqs.size)]
+    np.testing.assert_array_equal(
+        collect({"data": chunks, "xdims": 4, "ydims": 3}), expected)
+
+
+def test_interp_cube_lstsq_fallback(monkeypatch):
+    def not_positive_definite(*args, **kwargs):
+        raise scipy.linalg.LinAlgError("not positive definite")
+    monkeypatch.setattr(scipy.linalg, "cho_factor", not_positive_definite)
+
+    rng = np.random.default_rng(42)
+    nband, order = 8, 3
+    infreqs = 1e9 + 1e8*np.arange(nband)
+    wsums = rng.uniform(0.5, 2, size=(nband, 1))
+    model = rng.uniform(0.1, 5, size=(nband, 4, 3)).astype(np.float32)
+
+    got = collect(smooth.interp_cube(model, wsums, infreqs, infreqs, 1.3e9,
+                                     order))
+    expected = monomial_fit(model, wsums, infreqs, infreqs, 1.3e9, order)
+    np.testing.assert_allclose(got, expected, rtol=1e-4,
+                               atol=1e-5*np.abs(expected).max())
+
+
+def test_interp_cube_order_too_large():
+    model = np.ones((3, 2, 2), dtype=np.float32)
+    infreqs = 1e9 + 1e8*np.arange(3)
+    with pytest.raises(ValueError):
+        smooth.interp_cube(model, np.ones((3, 1)), infreqs, infreqs, 1e9, 4)
+
+
+def test_find_input_images(tmp_path):
+    for name in ["pref-0010-I-model.fits", "pref-0002-I-model.fits",
+                 "pref-0001-I-model.fits", "pref-0001-Q-model.fits",
+                 "pref-0001-model.fits", "pref-0001-I-residual.fits",
+                 "other-0001-I-model.fits"]:
+        (tmp_path / name).touch()
+    pref = str(tmp_path / "pref")
+
+    images, stokes = smooth.find_input_images(pref, "I")
+    assert stokes == "I"
+    assert [os.path.basename(_) for _ in images] == [
+        "pref-0001-I-model.fits", "pref-0002-I-model.fits",
+        "pref-0010-I-model.fits"]
+
+    # no images with this stokes in their name, use the plain ones
+    images, stokes = smooth.find_input_images(pref, "V")
+    assert stokes is None
+    assert [os.path.basename(_) for _ in images] == ["pref-0001-model.fits"]
+
+
+def test_find_input_images_missing_dir(tmp_path):
+    assert smooth.find_input_images(
+        str(tmp_path / "missing" / "pref"), "I") == ([], None)